@@ -5,8 +5,9 @@ import uuid
 import shutil
 import zipfile
 from flask import Flask, render_template, request, redirect, url_for, jsonify, send_from_directory, send_file
-from imgdownloader import WordPressImageDownloader
-from urllib.parse import urlparse
+from imgdownloader import WordPressImageDownloader, is_direct_image_url
+from transport import TRANSPORTS
+from distributed import create_broker, submit_job
 
 app = Flask(__name__)
 
@@ -18,6 +19,14 @@ os.makedirs(BASE_DOWNLOAD_DIR, exist_ok=True)
 SESSION_DOWNLOAD_DIR = os.path.join(BASE_DOWNLOAD_DIR, "sessions")
 os.makedirs(SESSION_DOWNLOAD_DIR, exist_ok=True)
 
+# ถ้ากำหนด DOWNLOAD_BROKER จะส่งงานเข้าคิวให้ worker (distributed.py) แทนการดาวน์โหลดในโปรเซสนี้
+# broker แบบ SQLite ใช้ได้เฉพาะเครื่องเดียวกัน จึงต้องรัน worker บนเครื่องเดียวกับ gunicorn เช่น
+#   DOWNLOAD_BROKER=~/BulkImageDownloader/broker.db python distributed.py worker --processes 4 &
+#   DOWNLOAD_BROKER=~/BulkImageDownloader/broker.db gunicorn -w 4 app:app
+DOWNLOAD_BROKER = os.environ.get('DOWNLOAD_BROKER', '')
+NUM_SHARDS = int(os.environ.get('DOWNLOAD_SHARDS', '4'))
+broker = create_broker(DOWNLOAD_BROKER) if DOWNLOAD_BROKER else None
+
 # ตัวแปรสำหรับเก็บสถานะการดาวน์โหลด
 download_status = {
     'is_running': False,
@@ -35,9 +44,14 @@ download_status = {
     'prefix': '',
     'use_numbering': False,
     'start_number': 1,
-    'digits': 3
+    'digits': 3,
+    'transport': 'requests',
+    'max_workers': 1
 }
 
+# ตัวดาวน์โหลดของงานล่าสุดในโปรเซสนี้ (ใช้สำหรับลองดาวน์โหลดซ้ำ)
+downloader_instance = None
+
 # ฟังก์ชันสำหรับสร้าง session ID
 def generate_session_id():
     return str(uuid.uuid4())
@@ -49,6 +63,12 @@ def is_safe_path(path):
     path = os.path.normpath(path)
     return path.startswith(base_path)
 
+# ฟังก์ชันสำหรับดึงสถานะของเซสชัน: จาก broker ในโหมด broker (ทุกโปรเซสเห็นตรงกัน) หรือจากโปรเซสนี้
+def get_session_status(session_id=''):
+    if broker and session_id:
+        return broker.session_status(session_id)
+    return download_status
+
 # ฟังก์ชันสำหรับเพิ่ม log
 def add_log(message):
     timestamp = time.strftime('%H:%M:%S')
@@ -56,14 +76,9 @@ def add_log(message):
     if len(download_status['logs']) > 100:  # เก็บ log ล่าสุด 100 รายการ
         download_status['logs'] = download_status['logs'][-100:]
 
-# ฟังก์ชันสำหรับตรวจสอบว่า URL เป็น URL ของรูปภาพโดยตรงหรือไม่
-def is_direct_image_url(url):
-    parsed_url = urlparse(url)
-    path = parsed_url.path.lower()
-    return path.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))
-
 # ฟังก์ชันสำหรับดาวน์โหลดรูปภาพในเธรดแยก
-def download_images_thread(urls, output_dir, prefix='', use_numbering=False, start_number=1, digits=3):
+def download_images_thread(urls, output_dir, prefix='', use_numbering=False, start_number=1, digits=3,
+                           transport='requests', max_workers=1):
     global downloader_instance
     
     try:
@@ -80,6 +95,12 @@ def download_images_thread(urls, output_dir, prefix='', use_numbering=False, sta
         download_status['use_numbering'] = use_numbering
         download_status['start_number'] = start_number
         download_status['digits'] = digits
+        download_status['transport'] = transport
+        download_status['max_workers'] = max_workers
+        
+        # ปิดการเชื่อมต่อของงานก่อนหน้า (http2 จะค้าง connection pool ไว้ถ้าไม่ปิด)
+        if downloader_instance is not None:
+            downloader_instance.transport.close()
         
         # สร้าง instance ของ WordPressImageDownloader
         downloader_instance = WordPressImageDownloader(
@@ -87,7 +108,9 @@ def download_images_thread(urls, output_dir, prefix='', use_numbering=False, sta
             prefix=prefix, 
             use_numbering=use_numbering,
             start_number=start_number,
-            digits=digits
+            digits=digits,
+            transport=transport,
+            max_workers=max_workers
         )
         
         # ประมวลผลแต่ละ URL
@@ -125,8 +148,7 @@ def download_images_thread(urls, output_dir, prefix='', use_numbering=False, sta
                     continue
                 
                 # ดาวน์โหลดรูปภาพแต่ละรูป
-                for img_url in images:
-                    success, message = downloader_instance.download_image(img_url)
+                for img_url, (success, message) in downloader_instance.download_images(images):
                     if success:
                         download_status['downloaded'] = downloader_instance.downloaded_count
                         add_log(f"ดาวน์โหลดสำเร็จ: {os.path.basename(img_url)}")
@@ -193,7 +215,8 @@ def index():
 
 @app.route('/download', methods=['POST'])
 def download():
-    if download_status['is_running']:
+    # โหมด broker แต่ละงานมีเซสชันของตัวเอง จึงไม่ต้องรอให้งานก่อนหน้าในโปรเซสนี้เสร็จ
+    if not broker and download_status['is_running']:
         return jsonify({'status': 'error', 'message': 'มีการดาวน์โหลดกำลังทำงานอยู่'})
     
     # รับข้อมูลจากฟอร์ม
@@ -203,6 +226,11 @@ def download():
     use_numbering = request.form.get('use_numbering') == 'on'
     start_number = int(request.form.get('start_number', '1'))
     digits = int(request.form.get('digits', '3'))
+    transport = request.form.get('transport', 'requests')
+    max_workers = int(request.form.get('max_workers', '1'))
+    
+    if transport not in TRANSPORTS:
+        return jsonify({'status': 'error', 'message': f'ไม่รู้จัก transport: {transport}'})
     
     # สร้าง session ID และโฟลเดอร์สำหรับเซสชันนี้
     session_id = generate_session_id()
@@ -221,6 +249,27 @@ def download():
     if not urls:
         return jsonify({'status': 'error', 'message': 'กรุณาระบุ URL อย่างน้อย 1 รายการ'})
     
+    # โหมด broker: แบ่งงานตาม host ลงคิว แล้วให้ worker หลายโปรเซสดาวน์โหลด
+    if broker:
+        submit_job(
+            broker,
+            urls,
+            session_download_dir,
+            num_shards=NUM_SHARDS,
+            session_id=session_id,
+            prefix=prefix,
+            use_numbering=use_numbering,
+            start_number=start_number,
+            digits=digits,
+            transport=transport,
+            max_workers=max_workers
+        )
+        return jsonify({
+            'status': 'success', 
+            'message': 'ส่งงานเข้าคิวแล้ว', 
+            'session_id': session_id
+        })
+    
     # อัปเดตสถานะการดาวน์โหลด
     download_status.update({
         'is_running': True,
@@ -236,13 +285,15 @@ def download():
         'prefix': prefix,
         'use_numbering': use_numbering,
         'start_number': start_number,
-        'digits': digits
+        'digits': digits,
+        'transport': transport,
+        'max_workers': max_workers
     })
     
     # เริ่มเธรดสำหรับดาวน์โหลด
     thread = threading.Thread(
         target=download_images_thread, 
-        args=(urls, session_download_dir, prefix, use_numbering, start_number, digits)
+        args=(urls, session_download_dir, prefix, use_numbering, start_number, digits, transport, max_workers)
     )
     thread.daemon = True
     thread.start()
@@ -257,6 +308,14 @@ def download():
 def retry_failed_images():
     global downloader_instance
     
+    # โหมด broker: นำรูปภาพที่ล้มเหลวกลับเข้าคิวให้ worker ดาวน์โหลดใหม่
+    session_id = request.form.get('session_id', '')
+    if broker and session_id:
+        if broker.get_session(session_id) is None:
+            return jsonify({"status": "error", "message": "เซสชันการดาวน์โหลดไม่ถูกต้อง"}), 404
+        retried = broker.retry_failed(session_id)
+        return jsonify({"status": "success", "message": f"ส่งรูปภาพที่ล้มเหลว {retried} รูปเข้าคิวแล้ว", "retried": retried})
+    
     if downloader_instance is None:
         return jsonify({"status": "error", "message": "ไม่มีการดาวน์โหลดที่ผ่านมา"}), 400
     
@@ -277,29 +336,38 @@ def retry_failed_images():
 
 @app.route('/status')
 def status():
-    return jsonify(download_status)
+    # ในโหมด broker สถานะจะรวมจากทุก worker ดังนั้นทุกโปรเซสของ gunicorn จะเห็นตรงกัน
+    session_status = get_session_status(request.args.get('session_id', ''))
+    if session_status is None:
+        return jsonify({'status': 'error', 'message': 'เซสชันการดาวน์โหลดไม่ถูกต้อง'}), 404
+    return jsonify(session_status)
 
 @app.route('/images/<path:filename>')
 def download_file(filename):
-    return send_from_directory(download_status['output_dir'], filename)
+    session_status = get_session_status(request.args.get('session_id', ''))
+    if session_status is None:
+        return jsonify({'status': 'error', 'message': 'เซสชันการดาวน์โหลดไม่ถูกต้อง'}), 404
+    return send_from_directory(session_status['output_dir'], filename)
 
 @app.route('/browse')
 def browse():
-    if not download_status['output_dir'] or not os.path.exists(download_status['output_dir']):
-        return render_template('browse.html', images=[], output_dir='', failed_images=[])
+    session_id = request.args.get('session_id', '')
+    session_status = get_session_status(session_id)
+    if not session_status or not session_status['output_dir'] or not os.path.exists(session_status['output_dir']):
+        return render_template('browse.html', images=[], output_dir='', failed_images=[], session_id=session_id)
     
     # ดึงรายการรูปภาพในโฟลเดอร์
     images = []
-    for filename in os.listdir(download_status['output_dir']):
+    for filename in os.listdir(session_status['output_dir']):
         if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp')):
             images.append(filename)
     
     # ส่งรายการรูปภาพที่ล้มเหลวไปด้วย
     failed_images = []
-    if 'failed_images' in download_status and download_status['failed_images']:
-        failed_images = download_status['failed_images']
+    if 'failed_images' in session_status and session_status['failed_images']:
+        failed_images = session_status['failed_images']
     
-    return render_template('browse.html', images=images, output_dir=download_status['output_dir'], failed_images=failed_images)
+    return render_template('browse.html', images=images, output_dir=session_status['output_dir'], failed_images=failed_images, session_id=session_id)
 
 @app.route('/select_directory', methods=['GET'])
 def select_directory():
@@ -353,7 +421,7 @@ def delete_images():
     try:
         # รับข้อมูลจาก request
         images_to_delete = request.form.getlist('images')
-        output_dir = download_status.get('output_dir', '')
+        output_dir = (get_session_status(request.form.get('session_id', '')) or {}).get('output_dir', '')
         
         if not output_dir or not os.path.exists(output_dir):
             return jsonify({'status': 'error', 'message': 'ไม่พบโฟลเดอร์ดาวน์โหลด'})
@@ -376,7 +444,7 @@ def delete_images():
 @app.route('/delete_all_images', methods=['POST'])
 def delete_all_images():
     try:
-        output_dir = download_status.get('output_dir', '')
+        output_dir = (get_session_status(request.form.get('session_id', '')) or {}).get('output_dir', '')
         
         if not output_dir or not os.path.exists(output_dir):
             return jsonify({'status': 'error', 'message': 'ไม่พบโฟลเดอร์ดาวน์โหลด'})
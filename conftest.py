@@ -0,0 +1 @@
+# ให้ pytest เพิ่มโฟลเดอร์หลักของโปรเจกต์ลงใน sys.path เพื่อ import โมดูลได้จาก tests/
@@ -0,0 +1,499 @@
+import os
+import json
+import time
+import uuid
+import zlib
+import socket
+import sqlite3
+import threading
+import argparse
+import multiprocessing
+import concurrent.futures
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from imgdownloader import WordPressImageDownloader, is_direct_image_url, DOWNLOADED, SKIPPED, FAILED, REJECTED
+from transport import TRANSPORTS
+
+# สถานะของงานที่ถือว่าเสร็จแล้ว
+FINISHED_STATUSES = ('done', DOWNLOADED, SKIPPED, FAILED, REJECTED)
+
+
+def shard_for_url(url, num_shards):
+    """คำนวณ shard จาก host ของ URL (ใช้ crc32 เพื่อให้ได้ค่าเดียวกันทุกโปรเซส/เครื่อง)"""
+    host = urlparse(url).netloc.lower()
+    return zlib.crc32(host.encode('utf-8')) % num_shards
+
+
+class SQLiteBroker:
+    """คิวงานแบบ SQLite สำหรับหลายโปรเซสบนเครื่องเดียวกัน
+
+    ใช้ WAL mode ซึ่งต้องใช้ shared memory บนเครื่องเดียว จึงไม่รองรับไฟล์บน network filesystem
+    หากต้องการกระจายงานหลายเครื่อง ให้เพิ่ม broker ที่รองรับเครือข่ายลงใน BROKERS
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as db:
+            # WAL ให้ worker อ่านสถานะได้ระหว่างที่โปรเซสอื่นเขียน (ใช้ได้เฉพาะเครื่องเดียวกัน)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    options TEXT NOT NULL,
+                    next_number INTEGER NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    shard INTEGER NOT NULL,
+                    number INTEGER,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    worker TEXT,
+                    message TEXT,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_claim ON tasks (status, shard, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS tasks_session ON tasks (session_id, status)")
+
+    @contextmanager
+    def _connect(self):
+        # เปิดการเชื่อมต่อใหม่ทุกครั้ง เพราะ sqlite3 ใช้ connection ข้ามเธรดไม่ได้
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def create_session(self, session_id, options):
+        """บันทึกเซสชันพร้อมตัวเลือกของตัวดาวน์โหลด"""
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO sessions (session_id, options, next_number, created_at) VALUES (?, ?, ?, ?)",
+                (session_id, json.dumps(options), options.get('start_number', 1), time.time())
+            )
+
+    def get_session(self, session_id):
+        """คืนค่าตัวเลือกของเซสชัน หรือ None ถ้าไม่พบ"""
+        with self._connect() as db:
+            row = db.execute("SELECT options FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row['options']) if row else None
+
+    def enqueue(self, session_id, kind, urls):
+        """เพิ่มงาน ('page' หรือ 'image') โดยแบ่ง shard ตาม host และจองเลขรันให้รูปภาพ"""
+        with self._transaction() as db:
+            self._enqueue(db, session_id, kind, urls)
+
+    def _enqueue(self, db, session_id, kind, urls):
+        now = time.time()
+        row = db.execute(
+            "SELECT options, next_number FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"ไม่พบเซสชัน: {session_id}")
+        options = json.loads(row['options'])
+        next_number = row['next_number']
+        numbering = kind == 'image' and options.get('use_numbering') and options.get('prefix')
+
+        for url in urls:
+            number = None
+            if numbering:
+                number = next_number
+                next_number += 1
+            db.execute(
+                "INSERT INTO tasks (session_id, kind, url, shard, number, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, kind, url, shard_for_url(url, options['num_shards']), number, now)
+            )
+        db.execute("UPDATE sessions SET next_number = ? WHERE session_id = ?", (next_number, session_id))
+
+    def claim(self, worker_id, shards=None, limit=10, lease_seconds=300):
+        """จองงานให้ worker ทีละชุดจาก shard เดียวกัน งานที่ค้างเกิน lease จะถูกจองใหม่ได้"""
+        now = time.time()
+        ready = "(status = 'pending' OR (status = 'running' AND updated_at < ?))"
+        params = [now - lease_seconds]
+        if shards is not None:
+            ready += f" AND shard IN ({', '.join('?' * len(shards))})"
+            params.extend(shards)
+
+        with self._transaction() as db:
+            # เลือก shard ของงานที่เก่าที่สุด เพื่อให้งานในชุดเดียวกันไปที่ host เดียวกัน
+            oldest = db.execute(f"SELECT shard FROM tasks WHERE {ready} ORDER BY id LIMIT 1", params).fetchone()
+            if oldest is None:
+                return []
+            rows = db.execute(
+                f"SELECT * FROM tasks WHERE {ready} AND shard = ? ORDER BY id LIMIT ?",
+                params + [oldest['shard'], limit]
+            ).fetchall()
+            db.executemany(
+                "UPDATE tasks SET status = 'running', worker = ?, updated_at = ? WHERE id = ?",
+                [(worker_id, now, row['id']) for row in rows]
+            )
+        return [dict(row) for row in rows]
+
+    def renew(self, worker_id, task_ids):
+        """ต่ออายุ lease ของงานที่ worker ยังทำอยู่"""
+        if not task_ids:
+            return
+        with self._transaction() as db:
+            db.execute(
+                f"UPDATE tasks SET updated_at = ? WHERE worker = ? AND status = 'running' "
+                f"AND id IN ({', '.join('?' * len(task_ids))})",
+                [time.time(), worker_id] + list(task_ids)
+            )
+
+    def finish(self, task_id, worker_id, status, message='', images=None):
+        """บันทึกผลของงาน และเพิ่มรูปภาพที่พบจากหน้าเว็บ (images) ลงคิวใน transaction เดียวกัน
+        คืนค่า False ถ้างานถูก worker อื่นจองไปแล้ว (lease หมดอายุ) ซึ่งจะไม่บันทึกอะไรเลย"""
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE tasks SET status = ?, message = ?, updated_at = ? "
+                "WHERE id = ? AND worker = ? AND status = 'running'",
+                (status, message, time.time(), task_id, worker_id)
+            )
+            if cursor.rowcount == 0:
+                return False
+            if images:
+                session_id = db.execute("SELECT session_id FROM tasks WHERE id = ?", (task_id,)).fetchone()[0]
+                self._enqueue(db, session_id, 'image', images)
+        return True
+
+    def retry_failed(self, session_id):
+        """นำรูปภาพที่ล้มเหลวของเซสชันกลับเข้าคิว คืนค่าจำนวนรูปภาพ"""
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE tasks SET status = 'pending', worker = NULL, message = NULL, updated_at = ? "
+                "WHERE session_id = ? AND kind = 'image' AND status = 'failed'",
+                (time.time(), session_id)
+            )
+        return cursor.rowcount
+
+    def has_open_tasks(self, session_id, shards=None):
+        """ตรวจสอบว่าเซสชันยังมีงานที่รอหรือกำลังทำอยู่ใน shard ที่ระบุหรือไม่"""
+        query = "SELECT 1 FROM tasks WHERE session_id = ? AND status IN ('pending', 'running')"
+        params = [session_id]
+        if shards is not None:
+            query += f" AND shard IN ({', '.join('?' * len(shards))})"
+            params.extend(shards)
+        with self._connect() as db:
+            return db.execute(query + " LIMIT 1", params).fetchone() is not None
+
+    def session_status(self, session_id):
+        """รวมสถานะของทุก worker ในเซสชันเป็นรูปแบบเดียวกับ download_status ของ app"""
+        options = self.get_session(session_id)
+        if options is None:
+            return None
+
+        with self._connect() as db:
+            counts = {}
+            for row in db.execute(
+                "SELECT kind, status, COUNT(*) AS n FROM tasks WHERE session_id = ? GROUP BY kind, status",
+                (session_id,)
+            ):
+                counts[(row['kind'], row['status'])] = row['n']
+            failed_images = [row['url'] for row in db.execute(
+                "SELECT url FROM tasks WHERE session_id = ? AND kind = 'image' AND status = 'failed' ORDER BY id",
+                (session_id,)
+            )]
+            workers = [row['worker'] for row in db.execute(
+                "SELECT DISTINCT worker FROM tasks WHERE session_id = ? AND worker IS NOT NULL ORDER BY worker",
+                (session_id,)
+            )]
+            recent = db.execute(
+                "SELECT updated_at, message FROM tasks WHERE session_id = ? AND message IS NOT NULL "
+                "ORDER BY updated_at DESC LIMIT 100",
+                (session_id,)
+            ).fetchall()
+
+        def count(kind, *statuses):
+            return sum(n for (k, s), n in counts.items() if k == kind and (not statuses or s in statuses))
+
+        logs = [f"[{time.strftime('%H:%M:%S', time.localtime(row['updated_at']))}] {row['message']}"
+                for row in reversed(recent)]
+        direct_images = options.get('direct_images', 0)
+
+        return {
+            'is_running': count('page', 'pending', 'running') + count('image', 'pending', 'running') > 0,
+            'total_urls': count('page') + direct_images,
+            'current_url_index': count('page', *FINISHED_STATUSES) + direct_images,
+            'current_url': '',
+            'found_images': count('image') - direct_images,
+            'downloaded': count('image', DOWNLOADED),
+            'skipped': count('image', SKIPPED),
+            'failed': count('image', FAILED),
+            'rejected': count('image', REJECTED),
+            'logs': logs,
+            'output_dir': options['output_dir'],
+            'session_id': session_id,
+            'failed_images': failed_images,
+            'prefix': options.get('prefix', ''),
+            'use_numbering': options.get('use_numbering', False),
+            'start_number': options.get('start_number', 1),
+            'digits': options.get('digits', 3),
+            'transport': options.get('transport', 'requests'),
+            'max_workers': options.get('max_workers', 1),
+            'num_shards': options['num_shards'],
+            'workers': workers
+        }
+
+
+BROKERS = {
+    SQLiteBroker.name: SQLiteBroker,
+}
+
+
+def create_broker(url):
+    """สร้าง broker จาก URL เช่น 'sqlite:///path/to/broker.db' หรือ path ของไฟล์ SQLite"""
+    if '://' not in url:
+        return SQLiteBroker(url)
+    scheme, _, location = url.partition('://')
+    if scheme not in BROKERS:
+        raise ValueError(f"ไม่รู้จัก broker: {scheme} (เลือกได้: {', '.join(BROKERS)})")
+    # sqlite:///abs/path -> /abs/path, sqlite://rel/path -> rel/path
+    return BROKERS[scheme](location)
+
+
+def submit_job(broker, urls, output_dir, num_shards=4, session_id=None, prefix='', use_numbering=False,
+               start_number=1, digits=3, transport='requests', max_workers=1):
+    """สร้างเซสชันและแบ่งงานลงคิว (ทำหน้าที่ coordinator) คืนค่า session ID"""
+    session_id = session_id or str(uuid.uuid4())
+    urls = [url.strip() for url in urls if url.strip()]
+    direct_images = [url for url in urls if is_direct_image_url(url)]
+    pages = [url for url in urls if not is_direct_image_url(url)]
+
+    broker.create_session(session_id, {
+        'output_dir': output_dir,
+        'num_shards': num_shards,
+        'prefix': prefix,
+        'use_numbering': use_numbering,
+        'start_number': start_number,
+        'digits': digits,
+        'transport': transport,
+        'max_workers': max_workers,
+        'direct_images': len(direct_images)
+    })
+    # ดึงรูปภาพจากหน้าเว็บก็ทำที่ worker ด้วย เพื่อกระจายงาน parse ออกไปหลายโปรเซส
+    broker.enqueue(session_id, 'image', direct_images)
+    broker.enqueue(session_id, 'page', pages)
+    return session_id
+
+
+class ShardWorker:
+    """Worker ที่ดึงงานจาก broker ตาม shard แล้วดาวน์โหลดด้วย WordPressImageDownloader"""
+
+    def __init__(self, broker, worker_id=None, shards=None, batch_size=10, poll_interval=1.0, lease_seconds=300):
+        self.broker = broker
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.shards = shards  # None คือรับงานจากทุก shard
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.downloaders = {}  # session_id -> WordPressImageDownloader
+
+    def get_downloader(self, session_id):
+        """สร้างหรือใช้ตัวดาวน์โหลดเดิมของเซสชัน (ใช้ transport ร่วมกันเพื่อคงการเชื่อมต่อไว้)"""
+        if session_id not in self.downloaders:
+            options = self.broker.get_session(session_id)
+            self.downloaders[session_id] = WordPressImageDownloader(
+                output_dir=options['output_dir'],
+                prefix=options['prefix'],
+                use_numbering=options['use_numbering'],
+                start_number=options['start_number'],
+                digits=options['digits'],
+                transport=options['transport'],
+                max_workers=options['max_workers']
+            )
+        return self.downloaders[session_id]
+
+    def process_task(self, task):
+        """ประมวลผลงานหนึ่งรายการและบันทึกผลลง broker"""
+        try:
+            downloader = self.get_downloader(task['session_id'])
+            if task['kind'] == 'page':
+                images = downloader.extract_images_from_url(task['url'])
+                self.broker.finish(task['id'], self.worker_id, 'done',
+                                   f"พบรูปภาพ {len(images)} รูปจาก {task['url']}", images=images)
+                return
+
+            status, message = downloader.download_image_with_status(task['url'], number=task['number'])
+            self.broker.finish(task['id'], self.worker_id, status, message)
+        except Exception as e:
+            try:
+                self.broker.finish(task['id'], self.worker_id, FAILED, f"เกิดข้อผิดพลาด: {task['url']} - {str(e)}")
+            except Exception as finish_error:
+                # บันทึกผลไม่ได้ (เช่น database is locked) งานจะถูกจองใหม่เมื่อ lease หมดอายุ
+                print(f"Worker {self.worker_id}: บันทึกผลงาน {task['id']} ไม่สำเร็จ: {finish_error}")
+
+    def run_batch(self):
+        """จองและประมวลผลงานหนึ่งชุด คืนค่าจำนวนงานที่ทำ"""
+        tasks = self.broker.claim(self.worker_id, self.shards, self.batch_size, self.lease_seconds)
+        if not tasks:
+            # ไม่มีงานให้ทำ ปิดการเชื่อมต่อทั้งหมดไว้ก่อน (จะสร้างใหม่เมื่อมีงานเข้ามา)
+            self.close_downloaders()
+            return 0
+
+        # ต่ออายุ lease ระหว่างทำงาน เพราะทั้งชุดอาจใช้เวลานานกว่า lease_seconds
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=([task['id'] for task in tasks], stop), daemon=True)
+        heartbeat.start()
+        try:
+            max_workers = self._batch_max_workers(tasks)
+            if max_workers <= 1:
+                for task in tasks:
+                    self.process_task(task)
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    list(executor.map(self.process_task, tasks))
+        finally:
+            stop.set()
+            heartbeat.join()
+
+        for session_id in {task['session_id'] for task in tasks}:
+            if not self.broker.has_open_tasks(session_id, self.shards):
+                self.close_downloaders(session_id)
+        return len(tasks)
+
+    def _batch_max_workers(self, tasks):
+        """จำนวนเธรดของชุดงาน (เซสชันที่สร้างตัวดาวน์โหลดไม่ได้จะไปบันทึกข้อผิดพลาดใน process_task)"""
+        max_workers = 1
+        for task in tasks:
+            try:
+                max_workers = max(max_workers, self.get_downloader(task['session_id']).max_workers)
+            except Exception:
+                continue
+        return max_workers
+
+    def close_downloaders(self, session_id=None):
+        """ปิด transport และลบตัวดาวน์โหลดของเซสชันออกจากแคช (ทุกเซสชันถ้าไม่ระบุ)"""
+        session_ids = list(self.downloaders) if session_id is None else [session_id]
+        for sid in session_ids:
+            downloader = self.downloaders.pop(sid, None)
+            if downloader is not None:
+                downloader.transport.close()
+
+    def _heartbeat(self, task_ids, stop):
+        while not stop.wait(self.lease_seconds / 3):
+            try:
+                self.broker.renew(self.worker_id, task_ids)
+            except Exception as e:
+                print(f"Worker {self.worker_id}: ต่ออายุ lease ไม่สำเร็จ: {e}")
+
+    def run(self, once=False):
+        """วนรับงานจนกว่าจะถูกหยุด หรือจนกว่าคิวว่างถ้า once=True"""
+        print(f"Worker {self.worker_id} started (shards: {self.shards if self.shards is not None else 'all'})")
+        try:
+            while True:
+                try:
+                    processed = self.run_batch()
+                except Exception as e:
+                    # เช่น database is locked ไม่ให้ worker หยุดทำงาน งานที่จองไว้จะถูกจองใหม่เมื่อ lease หมดอายุ
+                    print(f"Worker {self.worker_id}: เกิดข้อผิดพลาด: {e}")
+                    time.sleep(self.poll_interval)
+                    continue
+                if processed == 0:
+                    if once:
+                        break
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close_downloaders()
+
+
+def _run_worker(broker_url, shards, batch_size, once):
+    ShardWorker(create_broker(broker_url), shards=shards, batch_size=batch_size).run(once=once)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded image download workers - distribute download jobs across worker processes through a queue broker')
+    parser.add_argument('-b', '--broker', default=os.environ.get('DOWNLOAD_BROKER', ''), help='Broker URL or SQLite file path (default: $DOWNLOAD_BROKER)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    submit = subparsers.add_parser('submit', help='Shard a job onto the queue and print its session ID')
+    group = submit.add_mutually_exclusive_group(required=True)
+    group.add_argument('-u', '--url', help='URL of WordPress site or image to download')
+    group.add_argument('-f', '--file', help='File containing URLs (one URL per line)')
+    group.add_argument('-l', '--urls', nargs='+', help='Multiple URLs separated by space')
+    submit.add_argument('-o', '--output', default='downloaded_images', help='Output directory for downloaded images')
+    submit.add_argument('--shards', type=int, default=4, help='Number of host shards')
+    submit.add_argument('-p', '--prefix', default='', help='Add prefix to downloaded image filenames')
+    submit.add_argument('-n', '--numbering', action='store_true', help='Use sequential numbering with prefix')
+    submit.add_argument('-s', '--start', type=int, default=1, help='Starting number for sequential numbering')
+    submit.add_argument('-d', '--digits', type=int, default=3, help='Number of digits for sequential numbering')
+    submit.add_argument('-t', '--transport', choices=list(TRANSPORTS), default='requests', help='HTTP backend for image downloads')
+    submit.add_argument('-w', '--workers', type=int, default=1, help='Number of images each worker downloads concurrently')
+
+    worker = subparsers.add_parser('worker', help='Run download workers')
+    worker.add_argument('--shard', type=int, action='append', dest='shards', help='Only process this shard (repeatable, default: all shards)')
+    worker.add_argument('--processes', type=int, default=1, help='Number of worker processes to start')
+    worker.add_argument('--batch-size', type=int, default=10, help='Number of tasks to claim at a time')
+    worker.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+
+    status = subparsers.add_parser('status', help='Show aggregated status of a session')
+    status.add_argument('session_id', help='Session ID returned by submit')
+
+    args = parser.parse_args()
+    if not args.broker:
+        parser.error('a broker is required (use --broker or set DOWNLOAD_BROKER)')
+
+    if args.command == 'submit':
+        if args.url:
+            urls = [args.url]
+        elif args.file:
+            with open(args.file, 'r') as f:
+                urls = [line.strip() for line in f if line.strip()]
+        else:
+            urls = args.urls
+        session_id = submit_job(
+            create_broker(args.broker),
+            urls,
+            os.path.abspath(args.output),
+            num_shards=args.shards,
+            prefix=args.prefix,
+            use_numbering=args.numbering,
+            start_number=args.start,
+            digits=args.digits,
+            transport=args.transport,
+            max_workers=args.workers
+        )
+        print(session_id)
+    elif args.command == 'worker':
+        if args.processes <= 1:
+            _run_worker(args.broker, args.shards, args.batch_size, args.once)
+            return
+        processes = [
+            multiprocessing.Process(target=_run_worker, args=(args.broker, args.shards, args.batch_size, args.once))
+            for _ in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    elif args.command == 'status':
+        session_status = create_broker(args.broker).session_status(args.session_id)
+        if session_status is None:
+            parser.error(f'session not found: {args.session_id}')
+        print(json.dumps(session_status, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,26 @@ import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urlparse, urljoin, unquote
 import concurrent.futures
+import threading
 import argparse
 from tqdm import tqdm
+from transport import create_transport, TRANSPORTS
+
+# ผลลัพธ์ของการดาวน์โหลดรูปภาพหนึ่งรูป (ดู download_image_with_status)
+DOWNLOADED = 'downloaded'
+SKIPPED = 'skipped'
+FAILED = 'failed'  # ดาวน์โหลดไม่สำเร็จ นับใน failed_count/failed_images และลองใหม่ได้
+REJECTED = 'rejected'  # URL ไม่ถูกต้องหรือไม่ใช่รูปภาพ ไม่นับว่าล้มเหลวและลองใหม่ก็ไม่สำเร็จ
+
+def is_direct_image_url(url):
+    """ตรวจสอบว่า URL เป็น URL ของรูปภาพโดยตรงหรือไม่"""
+    parsed_url = urlparse(url)
+    path = parsed_url.path.lower()
+    return path.endswith(('.jpg', '.jpeg', '.png', '.gif', '.webp'))
 
 class WordPressImageDownloader:
-    def __init__(self, output_dir="downloaded_images", prefix="", use_numbering=False, start_number=1, digits=3):
+    def __init__(self, output_dir="downloaded_images", prefix="", use_numbering=False, start_number=1, digits=3,
+                 transport="requests", max_workers=1, transport_options=None):
         self.output_dir = output_dir
         self.prefix = prefix  # เพิ่มตัวแปรสำหรับ prefix
         self.use_numbering = use_numbering  # ใช้การรันตัวเลขหรือไม่
@@ -18,6 +33,13 @@ class WordPressImageDownloader:
         self.failed_count = 0
         self.skipped_count = 0
         self.failed_images = []  # เพิ่มรายการเก็บ URL ของรูปภาพที่ล้มเหลว
+        # backend สำหรับดาวน์โหลดรูปภาพ: ชื่อ ('requests' หรือ 'http2') พร้อม transport_options หรือ instance ที่สร้างไว้แล้ว
+        if isinstance(transport, str):
+            transport = create_transport(transport, **(transport_options or {}))
+        self.transport = transport
+        self.max_workers = max_workers  # จำนวนรูปภาพที่ดาวน์โหลดพร้อมกัน
+        self._lock = threading.Lock()  # ป้องกันตัวนับและการรันตัวเลขเมื่อดาวน์โหลดพร้อมกัน
+        self._claimed = set()  # ไฟล์ที่กำลังดาวน์โหลดอยู่ (กัน URL ซ้ำในหน้าเดียวกันเขียนไฟล์เดียวกันพร้อมกัน)
         
         # สร้างโฟลเดอร์สำหรับเก็บรูปภาพ
         if not os.path.exists(output_dir):
@@ -85,8 +107,13 @@ class WordPressImageDownloader:
             print(f"เกิดข้อผิดพลาดในการตรวจสอบ URL: {e}")
             return False
 
-    def download_image(self, img_url):
-        """ดาวน์โหลดรูปภาพจาก URL"""
+    def download_image(self, img_url, number=None):
+        """ดาวน์โหลดรูปภาพจาก URL (number ใช้กำหนดเลขรันเอง เช่น เลขที่จองไว้จาก broker)"""
+        status, message = self.download_image_with_status(img_url, number)
+        return status == DOWNLOADED, message
+    
+    def download_image_with_status(self, img_url, number=None):
+        """ดาวน์โหลดรูปภาพจาก URL คืนค่า (DOWNLOADED/SKIPPED/FAILED/REJECTED, ข้อความ)"""
         max_retries = 3
         retry_delay = 2  # 2 วินาที
 
@@ -104,7 +131,7 @@ class WordPressImageDownloader:
             print(f"URL ไม่ถูกต้อง: {img_url}")
             if original_url in self.failed_images:
                 self.failed_images.remove(original_url)
-            return False, f"URL ไม่ถูกต้อง: {img_url}"
+            return REJECTED, f"URL ไม่ถูกต้อง: {img_url}"
 
         for attempt in range(max_retries):
             try:
@@ -113,47 +140,57 @@ class WordPressImageDownloader:
                 filename = os.path.basename(parsed_url.path)
                 
                 # เพิ่ม prefix และตัวเลขถ้ามีการกำหนด
-                if self.use_numbering and self.prefix:
-                    number_str = str(self.current_number).zfill(self.digits)
-                    filename = f"{self.prefix}{number_str}_{filename}"
-                    self.current_number += 1
-                elif self.prefix:
-                    filename = f"{self.prefix}{filename}"
-                
-                # ตรวจสอบว่ามีไฟล์อยู่แล้วหรือไม่
-                filepath = os.path.join(self.output_dir, filename)
-                if os.path.exists(filepath):
-                    self.skipped_count += 1
-                    return False, f"ข้าม: {filename} (มีอยู่แล้ว)"
+                with self._lock:
+                    if self.use_numbering and self.prefix:
+                        if number is None:
+                            number = self.current_number
+                            self.current_number += 1
+                        number_str = str(number).zfill(self.digits)
+                        filename = f"{self.prefix}{number_str}_{filename}"
+                    elif self.prefix:
+                        filename = f"{self.prefix}{filename}"
                 
-                # ดาวน์โหลดรูปภาพ
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                    'Accept': 'image/webp,*/*',
-                    'Accept-Language': 'th-TH,th;q=0.9,en-US;q=0.8,en;q=0.7',
-                    'Referer': 'https://jas2015.com/'
-                }
-                response = requests.get(img_url, headers=headers, stream=True, timeout=15)
-                response.raise_for_status()
+                    # ตรวจสอบว่ามีไฟล์อยู่แล้วหรือไม่
+                    filepath = os.path.join(self.output_dir, filename)
+                    if os.path.exists(filepath) or filepath in self._claimed:
+                        self.skipped_count += 1
+                        return SKIPPED, f"ข้าม: {filename} (มีอยู่แล้ว)"
+                    self._claimed.add(filepath)
                 
-                # ตรวจสอบประเภท Content
-                content_type = response.headers.get('Content-Type', '').lower()
-                if not content_type.startswith('image/'):
-                    print(f"คำเตือน: ประเภท Content ไม่ใช่รูปภาพ: {content_type}")
-                    return False, f"ไม่ใช่รูปภาพ: {content_type}"
-                
-                # บันทึกไฟล์
-                with open(filepath, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        f.write(chunk)
-                
-                self.downloaded_count += 1
+                try:
+                    # ดาวน์โหลดรูปภาพ
+                    headers = {
+                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+                        'Accept': 'image/webp,*/*',
+                        'Accept-Language': 'th-TH,th;q=0.9,en-US;q=0.8,en;q=0.7',
+                        'Referer': 'https://jas2015.com/'
+                    }
+                    with self.transport.stream(img_url, headers=headers, timeout=15) as response:
+                        response.raise_for_status()
+                    
+                        # ตรวจสอบประเภท Content
+                        content_type = response.headers.get('Content-Type', '').lower()
+                        if not content_type.startswith('image/'):
+                            print(f"คำเตือน: ประเภท Content ไม่ใช่รูปภาพ: {content_type}")
+                            return REJECTED, f"ไม่ใช่รูปภาพ: {content_type}"
+                    
+                        # บันทึกไฟล์
+                        with open(filepath, 'wb') as f:
+                            for chunk in response.iter_content(chunk_size=8192):
+                                f.write(chunk)
                 
-                # ถ้าเคยล้มเหลวและตอนนี้ดาวน์โหลดสำเร็จ ให้ลบออกจากรายการล้มเหลว
-                if original_url in self.failed_images:
-                    self.failed_images.remove(original_url)
+                    with self._lock:
+                        self.downloaded_count += 1
                     
-                return True, f"ดาวน์โหลดสำเร็จ: {filename}"
+                        # ถ้าเคยล้มเหลวและตอนนี้ดาวน์โหลดสำเร็จ ให้ลบออกจากรายการล้มเหลว
+                        if original_url in self.failed_images:
+                            self.failed_images.remove(original_url)
+                    
+                    return DOWNLOADED, f"ดาวน์โหลดสำเร็จ: {filename}"
+                finally:
+                    # ปล่อยชื่อไฟล์ เมื่อสำเร็จไฟล์จะมีอยู่แล้ว เมื่อล้มเหลวให้ลองใหม่ได้
+                    with self._lock:
+                        self._claimed.discard(filepath)
             
             except requests.exceptions.RequestException as e:
                 # ถ้ายังไม่ใช่การพยายามครั้งสุดท้าย ให้รอและลองใหม่
@@ -164,11 +201,12 @@ class WordPressImageDownloader:
                     continue
                 
                 # ถ้าพยายามครบ 3 ครั้งแล้ว
-                self.failed_count += 1
-                # เพิ่ม URL ที่ล้มเหลวเข้าไปในรายการ
-                if original_url not in self.failed_images:
-                    self.failed_images.append(original_url)
-                return False, f"ล้มเหลวหลังจากพยายาม {max_retries} ครั้ง: {original_url} - {str(e)}"
+                with self._lock:
+                    self.failed_count += 1
+                    # เพิ่ม URL ที่ล้มเหลวเข้าไปในรายการ
+                    if original_url not in self.failed_images:
+                        self.failed_images.append(original_url)
+                return FAILED, f"ล้มเหลวหลังจากพยายาม {max_retries} ครั้ง: {original_url} - {str(e)}"
     
     def process_url(self, url):
         """ประมวลผล URL เพื่อดึงและดาวน์โหลดรูปภาพ"""
@@ -181,12 +219,37 @@ class WordPressImageDownloader:
         
         # ดาวน์โหลดรูปภาพด้วย progress bar
         with tqdm(total=len(images), desc="Downloading", unit="img") as pbar:
-            for img_url in images:
-                success, message = self.download_image(img_url)
+            for img_url, (success, message) in self.download_images(images):
                 if success:
                     pbar.set_description(f"Downloaded: {os.path.basename(urlparse(img_url).path)}")
                 pbar.update(1)
     
+    def download_images(self, images):
+        """ดาวน์โหลดรูปภาพหลายรูป คืนค่า (img_url, (success, message)) ทีละรูปตามลำดับที่เสร็จ"""
+        if self.max_workers <= 1:
+            for img_url in images:
+                yield img_url, self.download_image(img_url)
+            return
+        
+        # ดาวน์โหลดพร้อมกัน เมื่อใช้ http2 ทุกสตรีมจะใช้การเชื่อมต่อเดียวกันต่อ origin
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for img_url in images:
+                # จองเลขรันตามลำดับรูปภาพในหน้า ไม่ใช่ตามลำดับที่เธรดทำเสร็จ
+                number = self._reserve_number(img_url)
+                futures[executor.submit(self.download_image, img_url, number)] = img_url
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+    
+    def _reserve_number(self, img_url):
+        """จองเลขรันถัดไปให้รูปภาพ (เฉพาะ URL ที่ผ่านการตรวจสอบ เหมือนการดาวน์โหลดทีละรูป)"""
+        if not (self.use_numbering and self.prefix) or not self.validate_image_url(unquote(img_url)):
+            return None
+        with self._lock:
+            number = self.current_number
+            self.current_number += 1
+        return number
+    
     def process_urls_from_file(self, file_path):
         """ประมวลผล URL จากไฟล์"""
         try:
@@ -255,6 +318,8 @@ def main():
     parser.add_argument('-n', '--numbering', action='store_true', help='Use sequential numbering with prefix')
     parser.add_argument('-s', '--start', type=int, default=1, help='Starting number for sequential numbering')
     parser.add_argument('-d', '--digits', type=int, default=3, help='Number of digits for sequential numbering (e.g., 3 for 001, 002, ...)')
+    parser.add_argument('-t', '--transport', choices=list(TRANSPORTS), default='requests', help='HTTP backend for image downloads (http2 multiplexes streams over one connection per host)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of images to download concurrently')
     
     args = parser.parse_args()
     
@@ -263,7 +328,9 @@ def main():
         prefix=args.prefix, 
         use_numbering=args.numbering,
         start_number=args.start,
-        digits=args.digits
+        digits=args.digits,
+        transport=args.transport,
+        max_workers=args.workers
     )
     
     if args.url:
@@ -280,6 +347,7 @@ def main():
         print(f"Retry results: {success_count} succeeded, {still_failed} still failed")
     
     downloader.show_summary()
+    downloader.transport.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,184 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import pytest
+
+import transport
+from distributed import SQLiteBroker, ShardWorker, shard_for_url, submit_job
+from imgdownloader import WordPressImageDownloader
+
+
+class StubResponse:
+    def __init__(self, url):
+        self.url = url
+        self.headers = {'Content-Type': 'image/jpeg'}
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=8192):
+        yield self.url.encode('utf-8')
+
+
+class StubTransport:
+    """transport สำหรับทดสอบ ตอบทุก URL เป็นรูปภาพที่มีเนื้อหาเป็น URL นั้น"""
+
+    name = 'stub'
+
+    @contextmanager
+    def stream(self, url, headers=None, timeout=15):
+        yield StubResponse(url)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def broker(tmp_path):
+    return SQLiteBroker(str(tmp_path / 'broker.db'))
+
+
+def test_stale_worker_cannot_overwrite_reclaimed_task(broker, tmp_path):
+    submit_job(broker, ['https://jas2015.com/wp-content/uploads/a.jpg'], str(tmp_path / 'out'), num_shards=2)
+    [task] = broker.claim('w1')
+
+    # lease ของ w1 หมดอายุ w2 จึงจองงานเดิมได้
+    [reclaimed] = broker.claim('w2', lease_seconds=0)
+    assert reclaimed['id'] == task['id']
+
+    assert broker.finish(task['id'], 'w1', 'failed', 'stale') is False
+    assert broker.finish(task['id'], 'w2', 'downloaded', 'ok') is True
+
+
+def test_page_images_are_enqueued_only_by_the_lease_holder(broker, tmp_path):
+    session_id = submit_job(broker, ['https://jas2015.com/page'], str(tmp_path / 'out'),
+                            num_shards=2, prefix='p', use_numbering=True)
+    [page] = broker.claim('w1')
+    broker.claim('w2', lease_seconds=0)
+    images = ['https://jas2015.com/wp-content/uploads/a.jpg', 'https://jas2015.com/wp-content/uploads/b.jpg']
+
+    assert broker.finish(page['id'], 'w1', 'done', images=images) is False
+    assert broker.finish(page['id'], 'w2', 'done', images=images) is True
+
+    tasks = broker.claim('w3')
+    assert [(task['url'], task['number']) for task in tasks] == list(zip(images, [1, 2]))
+    assert broker.session_status(session_id)['found_images'] == 2
+
+
+def test_heartbeat_renews_lease_during_long_batch(broker, tmp_path):
+    submit_job(broker, ['https://jas2015.com/wp-content/uploads/a.jpg'], str(tmp_path / 'out'), num_shards=1)
+    worker = ShardWorker(broker, worker_id='w1', lease_seconds=0.3)
+
+    def slow_task(task):
+        time.sleep(0.5)
+        assert broker.claim('w2', lease_seconds=0.3) == []
+        broker.finish(task['id'], worker.worker_id, 'downloaded', 'ok')
+
+    worker.process_task = slow_task
+    assert worker.run_batch() == 1
+
+
+def test_worker_closes_downloaders_of_finished_sessions(broker, tmp_path):
+    submit_job(broker, ['https://jas2015.com/wp-content/uploads/a.jpg'], str(tmp_path / 'out'), num_shards=1)
+    worker = ShardWorker(broker, worker_id='w1')
+    closed = []
+
+    def fake_task(task):
+        downloader = worker.get_downloader(task['session_id'])
+        downloader.transport.close = lambda: closed.append(task['session_id'])
+        broker.finish(task['id'], worker.worker_id, 'downloaded', 'ok')
+
+    worker.process_task = fake_task
+    worker.run_batch()
+
+    assert worker.downloaders == {}
+    assert len(closed) == 1
+
+
+def test_retry_failed_requeues_failed_images(broker, tmp_path):
+    session_id = submit_job(broker, ['https://jas2015.com/wp-content/uploads/a.jpg'], str(tmp_path / 'out'), num_shards=1)
+    [task] = broker.claim('w1')
+    broker.finish(task['id'], 'w1', 'failed', 'error')
+    assert broker.session_status(session_id)['failed_images'] == [task['url']]
+
+    assert broker.retry_failed(session_id) == 1
+
+    status = broker.session_status(session_id)
+    assert status['failed_images'] == []
+    assert status['is_running'] is True
+    assert [t['id'] for t in broker.claim('w2')] == [task['id']]
+
+
+def test_rejected_images_are_not_counted_as_failed(broker, tmp_path):
+    session_id = submit_job(broker, ['https://example.com/wp-content/uploads/a.jpg'], str(tmp_path / 'out'), num_shards=1)
+    worker = ShardWorker(broker, worker_id='w1')
+
+    worker.run_batch()
+
+    # ตรงกับการดาวน์โหลดในโปรเซสเดียว ซึ่งไม่นับ URL ที่ไม่ถูกต้องใน failed_count/failed_images
+    status = broker.session_status(session_id)
+    assert (status['failed'], status['rejected'], status['failed_images']) == (0, 1, [])
+    assert broker.retry_failed(session_id) == 0
+
+
+def test_worker_survives_broken_session_and_busy_database(broker, tmp_path, monkeypatch):
+    bad_session = submit_job(broker, ['https://jas2015.com/wp-content/uploads/a.jpg'], str(tmp_path / 'bad'),
+                             num_shards=1, transport='no-such-transport')
+    good_session = submit_job(broker, ['https://example.com/wp-content/uploads/b.jpg'], str(tmp_path / 'good'),
+                              num_shards=1)
+    worker = ShardWorker(broker, worker_id='w1', poll_interval=0)
+
+    # claim ครั้งแรกล้มเหลวเหมือน database is locked
+    claim = broker.claim
+    calls = []
+
+    def flaky_claim(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise sqlite3.OperationalError('database is locked')
+        return claim(*args, **kwargs)
+
+    monkeypatch.setattr(broker, 'claim', flaky_claim)
+    worker.run(once=True)
+
+    # สร้างตัวดาวน์โหลดไม่ได้ บันทึกเป็นล้มเหลวแทนที่จะทำให้ worker หยุด
+    assert broker.session_status(bad_session)['failed'] == 1
+    assert broker.session_status(good_session)['is_running'] is False
+
+
+def test_shard_workers_split_job_by_host_and_aggregate_status(broker, tmp_path, monkeypatch):
+    pages = {
+        'https://jas2015.com/page': ['https://jas2015.com/wp-content/uploads/a.jpg',
+                                     'https://jas2015.com/wp-content/uploads/b.jpg'],
+        'https://img.jas2015.com/page': ['https://img.jas2015.com/wp-content/uploads/c.jpg'],
+    }
+    monkeypatch.setitem(transport.TRANSPORTS, StubTransport.name, StubTransport)
+    monkeypatch.setattr(WordPressImageDownloader, 'extract_images_from_url', lambda self, url: pages[url])
+    # สองโฮสต์นี้อยู่คนละ shard เมื่อแบ่งเป็น 2 shard
+    assert shard_for_url('https://img.jas2015.com/page', 2) == 0
+    assert shard_for_url('https://jas2015.com/page', 2) == 1
+
+    output_dir = tmp_path / 'out'
+    session_id = submit_job(broker, list(pages), str(output_dir), num_shards=2,
+                            prefix='p', use_numbering=True, transport=StubTransport.name)
+    ShardWorker(broker, worker_id='w0', shards=[0]).run(once=True)
+    ShardWorker(broker, worker_id='w1', shards=[1]).run(once=True)
+
+    # เลขรันถูกจองตามลำดับที่หน้าเว็บถูกประมวลผล (w0 ทำหน้าของ img.jas2015.com ก่อน)
+    assert sorted(os.listdir(output_dir)) == ['p001_c.jpg', 'p002_a.jpg', 'p003_b.jpg']
+    assert (output_dir / 'p002_a.jpg').read_bytes() == b'https://jas2015.com/wp-content/uploads/a.jpg'
+
+    with sqlite3.connect(broker.path) as db:
+        rows = db.execute("SELECT url, worker FROM tasks WHERE session_id = ?", (session_id,)).fetchall()
+    for url, worker in rows:
+        expected = 'w0' if urlparse(url).netloc == 'img.jas2015.com' else 'w1'
+        assert worker == expected, url
+
+    status = broker.session_status(session_id)
+    assert status['is_running'] is False
+    assert (status['total_urls'], status['current_url_index'], status['found_images']) == (2, 2, 3)
+    assert (status['downloaded'], status['skipped'], status['failed']) == (3, 0, 0)
+    assert status['workers'] == ['w0', 'w1']
@@ -0,0 +1,201 @@
+import os
+import socket
+import threading
+
+import dns.exception
+import dns.resolver
+import h2.config
+import h2.connection
+import h2.events
+import pytest
+import requests
+
+from imgdownloader import WordPressImageDownloader
+from transport import DNSCache, HTTP2Transport
+
+
+class H2CServer:
+    """เซิร์ฟเวอร์ HTTP/2 แบบไม่เข้ารหัส (h2c) สำหรับทดสอบ นับจำนวนการเชื่อมต่อที่เข้ามา"""
+
+    def __init__(self):
+        self.connections = 0
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(client,), daemon=True).start()
+
+    def _serve(self, client):
+        conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        conn.initiate_connection()
+        client.sendall(conn.data_to_send())
+        while True:
+            try:
+                data = client.recv(65535)
+            except OSError:
+                return
+            if not data:
+                return
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    path = dict(event.headers)[b':path']
+                    status = '404' if b'missing' in path else '200'
+                    body = b'IMG' + path
+                    conn.send_headers(event.stream_id, [
+                        (':status', status),
+                        ('content-type', 'image/png'),
+                        ('content-length', str(len(body))),
+                    ])
+                    conn.send_data(event.stream_id, body, end_stream=True)
+            client.sendall(conn.data_to_send())
+
+    def url(self, path):
+        return f'http://localhost:{self.port}{path}'
+
+    def close(self):
+        self.sock.close()
+
+
+class CountingDNSCache(DNSCache):
+    def __init__(self, ttl=60):
+        super().__init__(min_ttl=0)
+        self.ttl = ttl
+        self.lookups = 0
+
+    def _lookup(self, host, timeout=None):
+        self.lookups += 1
+        return ['127.0.0.1'], self.ttl
+
+
+class LocalDownloader(WordPressImageDownloader):
+    def validate_image_url(self, img_url):
+        return True
+
+
+@pytest.fixture
+def server():
+    server = H2CServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def transport():
+    transport = HTTP2Transport(dns_cache=CountingDNSCache(), http1=False)
+    yield transport
+    transport.close()
+
+
+def test_stream_uses_http2(server, transport):
+    with transport.stream(server.url('/a.png')) as response:
+        response.raise_for_status()
+        assert response.http_version == 'HTTP/2'
+        assert b''.join(response.iter_content()) == b'IMG/a.png'
+
+
+def test_http_error_maps_to_requests(server, transport):
+    with pytest.raises(requests.exceptions.HTTPError):
+        with transport.stream(server.url('/missing.png')) as response:
+            response.raise_for_status()
+
+
+def test_concurrent_downloads_share_one_connection(server, transport, tmp_path):
+    downloader = LocalDownloader(output_dir=str(tmp_path), prefix='p', use_numbering=True,
+                                 transport=transport, max_workers=8)
+    urls = [server.url(f'/{i}.png') for i in range(20)]
+
+    results = list(downloader.download_images(urls))
+
+    assert all(success for _, (success, _) in results)
+    assert server.connections == 1
+    assert transport.dns_cache.lookups == 1
+    # เลขรันเรียงตามลำดับรูปภาพในหน้า
+    assert sorted(os.listdir(tmp_path)) == sorted(f'p{i + 1:03d}_{i}.png' for i in range(20))
+
+
+def test_concurrent_duplicate_urls_download_once(server, transport, tmp_path):
+    downloader = LocalDownloader(output_dir=str(tmp_path), transport=transport, max_workers=8)
+
+    results = list(downloader.download_images([server.url('/a.png')] * 8))
+
+    assert sorted(success for _, (success, _) in results) == [False] * 7 + [True]
+    assert downloader.downloaded_count == 1
+    assert downloader.skipped_count == 7
+    assert os.listdir(tmp_path) == ['a.png']
+    assert (tmp_path / 'a.png').read_bytes() == b'IMG/a.png'
+
+
+def test_dns_cache_expires_after_ttl():
+    cache = CountingDNSCache(ttl=0)
+
+    cache.resolve('example.test')
+    cache.resolve('example.test')
+
+    assert cache.lookups == 2
+
+
+def test_hosts_file_overrides_dns(tmp_path, monkeypatch):
+    hosts = tmp_path / 'hosts'
+    hosts.write_text('127.0.0.1 localhost\n10.1.2.3  cdn.jas2015.com  # override\n')
+
+    def no_dns(*args, **kwargs):
+        raise AssertionError('DNS should not be queried for hosts in the hosts file')
+
+    monkeypatch.setattr(dns.resolver, 'resolve', no_dns)
+    cache = DNSCache(hosts_path=str(hosts))
+
+    assert cache.resolve('CDN.jas2015.com') == ['10.1.2.3']
+
+
+def test_dns_lookup_is_bounded_by_request_timeout(tmp_path, monkeypatch):
+    lifetimes = []
+
+    def slow_resolve(host, rdtype, lifetime=None):
+        lifetimes.append(lifetime)
+        raise dns.exception.Timeout()
+
+    monkeypatch.setattr(dns.resolver, 'resolve', slow_resolve)
+    monkeypatch.setattr(socket, 'getaddrinfo', lambda *args, **kwargs: [])
+    cache = DNSCache(hosts_path=str(tmp_path / 'missing-hosts'))
+
+    cache.resolve('img.jas2015.com', timeout=2)
+
+    assert lifetimes and all(0 < lifetime <= 2 for lifetime in lifetimes)
+
+
+def test_resolve_failure_maps_to_connection_error():
+    cache = DNSCache()
+
+    def fail(host, timeout=None):
+        raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+    cache._lookup = fail
+    transport = HTTP2Transport(dns_cache=cache)
+    try:
+        with pytest.raises(requests.exceptions.ConnectionError):
+            with transport.stream('http://nx.example.test/a.png'):
+                pass
+    finally:
+        transport.close()
+
+
+def test_downloader_forwards_transport_options(server, tmp_path):
+    # เซิร์ฟเวอร์ h2c ตอบได้เฉพาะเมื่อส่ง http1=False ผ่านไปถึง HTTP2Transport
+    downloader = LocalDownloader(output_dir=str(tmp_path), transport='http2',
+                                 transport_options={'http1': False})
+    try:
+        success, message = downloader.download_image(f'http://127.0.0.1:{server.port}/a.png')
+    finally:
+        downloader.transport.close()
+
+    assert success, message
+    assert (tmp_path / 'a.png').read_bytes() == b'IMG/a.png'
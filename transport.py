@@ -0,0 +1,208 @@
+import os
+import ipaddress
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+import dns.exception
+import dns.resolver
+import httpcore
+import httpx
+import requests
+
+
+if os.name == 'nt':
+    HOSTS_PATH = os.path.join(os.environ.get('SystemRoot', r'C:\Windows'), 'System32', 'drivers', 'etc', 'hosts')
+else:
+    HOSTS_PATH = '/etc/hosts'
+
+
+class DNSCache:
+    """แคช DNS ภายในโปรเซส โดยเคารพค่า TTL ของแต่ละระเบียน"""
+
+    def __init__(self, default_ttl=300, min_ttl=5, max_ttl=3600, hosts_path=HOSTS_PATH):
+        self.default_ttl = default_ttl  # ใช้เมื่อไม่ทราบ TTL จริง (เช่น /etc/hosts หรือ getaddrinfo)
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.hosts_path = hosts_path
+        self._entries = {}  # host -> (expires_at, [ip, ...])
+        self._lock = threading.Lock()
+
+    def resolve(self, host, timeout=None):
+        """คืนรายการ IP ของ host จากแคช หรือ resolve ใหม่ถ้าหมดอายุ (timeout จำกัดเวลาค้นหา DNS รวม)"""
+        # ถ้าเป็น IP อยู่แล้วไม่ต้อง resolve
+        try:
+            ipaddress.ip_address(host)
+            return [host]
+        except ValueError:
+            pass
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry and entry[0] > now:
+                return list(entry[1])
+
+        addresses, ttl = self._lookup(host, timeout)
+        ttl = max(self.min_ttl, min(self.max_ttl, ttl))
+        with self._lock:
+            self._entries[host] = (time.monotonic() + ttl, addresses)
+        return list(addresses)
+
+    def invalidate(self, host):
+        """ลบ host ออกจากแคช"""
+        with self._lock:
+            self._entries.pop(host, None)
+
+    def _lookup(self, host, timeout=None):
+        """ค้นหาจากไฟล์ hosts ก่อน แล้วจึงค้นหา A/AAAA พร้อม TTL และถอยกลับไปใช้ getaddrinfo ถ้าไม่สำเร็จ"""
+        # ให้ผลเหมือน requests ซึ่งเคารพ /etc/hosts ก่อน DNS
+        addresses = self._hosts_lookup(host)
+        if addresses:
+            return addresses, self.default_ttl
+
+        ttls = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for rdtype in ('A', 'AAAA'):
+            # A และ AAAA ใช้เวลารวมกันไม่เกิน timeout ของคำขอ
+            lifetime = None
+            if deadline is not None:
+                lifetime = deadline - time.monotonic()
+                if lifetime <= 0:
+                    break
+            try:
+                answer = dns.resolver.resolve(host, rdtype, lifetime=lifetime)
+            except dns.exception.DNSException:
+                continue
+            addresses.extend(rdata.address for rdata in answer)
+            ttls.append(answer.rrset.ttl)
+
+        if addresses:
+            return addresses, min(ttls)
+
+        # เช่น host ที่ resolve ผ่าน mDNS หรือ NSS อื่นๆ ของระบบ
+        infos = socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)
+        for info in infos:
+            ip = info[4][0]
+            if ip not in addresses:
+                addresses.append(ip)
+        return addresses, self.default_ttl
+
+    def _hosts_lookup(self, host):
+        """คืนรายการ IP ของ host จากไฟล์ hosts (รายการว่างถ้าไม่พบ)"""
+        addresses = []
+        try:
+            with open(self.hosts_path, 'r', encoding='utf-8', errors='ignore') as f:
+                for line in f:
+                    fields = line.split('#', 1)[0].split()
+                    if len(fields) >= 2 and host.lower() in (name.lower() for name in fields[1:]):
+                        if fields[0] not in addresses:
+                            addresses.append(fields[0])
+        except OSError:
+            return []
+        return addresses
+
+
+class CachingNetworkBackend(httpcore.SyncBackend):
+    """Network backend ของ httpcore ที่เชื่อมต่อผ่าน IP จาก DNSCache"""
+
+    def __init__(self, dns_cache):
+        self.dns_cache = dns_cache
+
+    def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        # resolve ไม่ได้ให้ถือเป็นการเชื่อมต่อล้มเหลว เพื่อให้ถูกแปลงเป็น ConnectionError เหมือน requests
+        try:
+            addresses = self.dns_cache.resolve(host, timeout)
+        except OSError as e:
+            raise httpcore.ConnectError(f"resolve {host} ไม่สำเร็จ: {e}") from e
+
+        last_error = None
+        for ip in addresses:
+            try:
+                return super().connect_tcp(ip, port, timeout, local_address, socket_options)
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                last_error = e
+
+        # เชื่อมต่อไม่ได้ทุก IP ให้ resolve ใหม่ในครั้งถัดไป
+        self.dns_cache.invalidate(host)
+        if last_error is None:
+            raise httpcore.ConnectError(f"ไม่พบ IP ของ {host}")
+        raise last_error
+
+
+class RequestsTransport:
+    """ดาวน์โหลดผ่าน requests/urllib3 (HTTP/1.1) แบบเดิม"""
+
+    name = 'requests'
+
+    @contextmanager
+    def stream(self, url, headers=None, timeout=15):
+        response = requests.get(url, headers=headers, stream=True, timeout=timeout)
+        try:
+            yield response
+        finally:
+            response.close()
+
+    def close(self):
+        pass
+
+
+class _HTTP2Response:
+    """ห่อ httpx.Response ให้ใช้งานได้เหมือน requests.Response"""
+
+    def __init__(self, response):
+        self._response = response
+        self.headers = response.headers
+        self.status_code = response.status_code
+        self.http_version = response.http_version
+
+    def raise_for_status(self):
+        try:
+            self._response.raise_for_status()
+        except httpx.HTTPStatusError as e:
+            raise requests.exceptions.HTTPError(str(e)) from e
+
+    def iter_content(self, chunk_size=8192):
+        return self._response.iter_bytes(chunk_size=chunk_size)
+
+
+class HTTP2Transport:
+    """ดาวน์โหลดผ่าน httpx แบบ HTTP/2 ใช้การเชื่อมต่อเดียวต่อ origin ร่วมกันหลายสตรีม"""
+
+    name = 'http2'
+
+    def __init__(self, dns_cache=None, verify=True, http1=True):
+        self.dns_cache = dns_cache or DNSCache()
+        # http1=False ใช้กับเซิร์ฟเวอร์ h2c (HTTP/2 แบบไม่เข้ารหัส) ที่รู้ล่วงหน้าว่ารองรับ HTTP/2
+        transport = httpx.HTTPTransport(http2=True, http1=http1, verify=verify)
+        # httpx ไม่เปิดให้กำหนด network backend โดยตรง จึงตั้งค่าที่ pool ของ httpcore
+        transport._pool._network_backend = CachingNetworkBackend(self.dns_cache)
+        self.client = httpx.Client(transport=transport)
+
+    @contextmanager
+    def stream(self, url, headers=None, timeout=15):
+        # แปลงข้อผิดพลาดของ httpx ให้เป็นของ requests เพื่อให้ตัวดาวน์โหลดจัดการแบบเดียวกัน
+        try:
+            with self.client.stream('GET', url, headers=headers, timeout=timeout) as response:
+                yield _HTTP2Response(response)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e)) from e
+        except httpx.HTTPError as e:
+            raise requests.exceptions.ConnectionError(str(e)) from e
+
+    def close(self):
+        self.client.close()
+
+
+TRANSPORTS = {
+    RequestsTransport.name: RequestsTransport,
+    HTTP2Transport.name: HTTP2Transport,
+}
+
+
+def create_transport(name='requests', **kwargs):
+    """สร้าง transport ตามชื่อ ('requests' หรือ 'http2')"""
+    if name not in TRANSPORTS:
+        raise ValueError(f"ไม่รู้จัก transport: {name} (เลือกได้: {', '.join(TRANSPORTS)})")
+    return TRANSPORTS[name](**kwargs)